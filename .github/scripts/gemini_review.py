@@ -1,57 +1,73 @@
+import hashlib
+import itertools
 import json
 import os
+import random
 import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import google.generativeai as genai
 from github import Auth, Github
 
+try:
+    import ijson
+except ImportError:  # ijson is optional; fall back to a full parse
+    ijson = None
 
-def parse_diff_to_changed_lines(patch):
-    """
-    Parses a git diff patch to identify which lines in the new file were added or modified.
-    Returns a set of line numbers (integers) in the new file.
-    """
-    changed_lines = set()
-    if not patch:
-        return changed_lines
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib
+    orjson = None
 
-    # Regex to match @@ -old_start,old_count +new_start,new_count @@
-    # Sometimes count is omitted if it's 1
-    hunk_header_regex = re.compile(r"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+if orjson is not None:
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+else:
+    json_loads = json.loads
 
-    current_new_line = 0
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
 
-    lines = patch.split("\n")
-    for line in lines:
-        match = hunk_header_regex.match(line)
-        if match:
-            current_new_line = int(match.group(2))
-            continue
 
-        if line.startswith("+"):
-            changed_lines.add(current_new_line)
-            current_new_line += 1
-        elif line.startswith(" "):
-            current_new_line += 1
-        elif line.startswith("-"):
-            # Removed line, does not advance new_line index
-            pass
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-pro-latest")
 
-    return changed_lines
+# Gemini enforces strict concurrency limits, so keep the fan-out small
+GEMINI_CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "2"))
 
+# Retry policy for rate-limited (429) Gemini requests
+GEMINI_MAX_ATTEMPTS = 5
+GEMINI_MAX_BACKOFF_SECONDS = 30
 
-def get_ai_review(filename, patch):
-    """
-    Sends the patch to Gemini for review.
-    """
-    model = genai.GenerativeModel("gemini-pro-latest")
+# Requests per minute to self-pace below Gemini's quota (0 disables the limit)
+GEMINI_RPM = int(os.environ.get("GEMINI_RPM", "15"))
+
+# Upper bound on PR files fetched and reviewed, to avoid paging through huge PRs
+# (0 or less disables the cap)
+MAX_FILES = int(os.environ.get("MAX_FILES", "50"))
 
-    prompt = f"""
+# Patches longer than this are truncated at a hunk boundary before prompting
+MAX_PATCH_CHARS = int(os.environ.get("GEMINI_MAX_PATCH_CHARS", "20000"))
+
+# Patches smaller than this are packed together into a single Gemini request
+BATCH_MAX_CHARS = int(os.environ.get("GEMINI_BATCH_MAX_CHARS", "8000"))
+
+# Reviews are cached by (model, prompt, truncation budget, filename, patch) so
+# unchanged files are not re-reviewed
+CACHE_DIR = os.environ.get(
+    "GEMINI_REVIEW_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "gemini_review"),
+)
+
+# Reviewer persona and checklist shared by the single-file and batch prompts
+REVIEWER_ROLE = """
 You are a strict Senior Go (Golang) Open Source Maintainer who follows the "Clean Code" philosophy.
 Your goal is to ensure code is readable, idiomatic, and secure.
+"""
 
-Review the following git diff for file: {filename}.
-
+REVIEWER_GUIDELINES = """
 **Your Philosophy:**
 We believe in **Self-Documenting Code**.
 - Do NOT ask for comments to explain "what" the code is doing.
@@ -75,13 +91,22 @@ We believe in **Self-Documenting Code**.
 
 4. **Configuration:**
    - **CRITICAL:** Flag any hardcoded secrets or absolute file paths.
+"""
 
+# {filename} and {patch} are filled in per file
+PROMPT_TEMPLATE = (
+    REVIEWER_ROLE
+    + """
+Review the following git diff for file: {filename}.
+"""
+    + REVIEWER_GUIDELINES
+    + """
 Output strictly valid JSON in the following format:
 [
-  {{
+  {
     "line": <line_number_in_new_file>,
     "message": "<your_review_comment>"
-  }}
+  }
 ]
 
 RULES:
@@ -92,24 +117,445 @@ RULES:
 Diff:
 {patch}
 """
+)
+
+# {file_count} and {diffs} are filled in per batch
+BATCH_PROMPT_TEMPLATE = (
+    REVIEWER_ROLE
+    + """
+Review the following git diffs for {file_count} files.
+"""
+    + REVIEWER_GUIDELINES
+    + """
+Output strictly valid JSON in the following format, with one key per file:
+{
+  "<file_name>": [
+    {
+      "line": <line_number_in_new_file>,
+      "message": "<your_review_comment>"
+    }
+  ]
+}
+
+RULES:
+- Only provide comments for lines that are ADDED or MODIFIED.
+- Include every file; if a file is clean and readable, map it to an empty list [].
+- Do not include markdown formatting.
+
+Diffs:
+{diffs}
+"""
+)
+
+# Split the templates around their placeholders once at import, so building a
+# prompt is a plain "".join instead of re-formatting the whole template
+_PROMPT_PREFIX, _, _rest = PROMPT_TEMPLATE.partition("{filename}")
+_PROMPT_MID, _, _PROMPT_SUFFIX = _rest.partition("{patch}")
+
+_BATCH_PROMPT_PREFIX, _, _rest = BATCH_PROMPT_TEMPLATE.partition("{file_count}")
+_BATCH_PROMPT_MID, _, _BATCH_PROMPT_SUFFIX = _rest.partition("{diffs}")
+del _rest
+
+# Part of the review cache key, so editing the prompts invalidates cached reviews
+_PROMPT_FINGERPRINT = hashlib.sha256(
+    (PROMPT_TEMPLATE + "\0" + BATCH_PROMPT_TEMPLATE).encode()
+).hexdigest()
+
+# Matches @@ -old_start,old_count +new_start,new_count @@
+# Sometimes count is omitted if it's 1
+_HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@", re.MULTILINE)
+
+# Matches the prefix character of every diff line we care about
+_DIFF_LINE_RE = re.compile(r"^([ +@-])", re.MULTILINE)
+
+# Strips an optional ```json ... ``` markdown fence around the model output
+_JSON_FENCE_RE = re.compile(r"^\s*(?:```(?:json)?\s*)?(.*?)(?:\s*```)?\s*$", re.DOTALL)
+
+# Find the outermost JSON array/object when the model wraps it in extra prose
+_JSON_ARRAY_RE = re.compile(r"\[.*\]", re.DOTALL)
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+# Match a line consisting only of a comment, per comment syntax. Go directives
+# such as //go:build, // +build, //nolint and other //word: forms change
+# behavior and are deliberately not treated as comments.
+_HASH_COMMENT_RE = re.compile(r"^\s*#.*$")
+_SLASH_COMMENT_RE = re.compile(r"^\s*//(?!\s*\+build|nolint\b|[A-Za-z0-9_.-]+:).*$")
+
+# Comment syntax by file extension (or bare filename for extensionless files).
+# Files not listed here only count as trivial for whitespace-only changes.
+_COMMENT_RE_BY_EXTENSION = {
+    ".py": _HASH_COMMENT_RE,
+    ".sh": _HASH_COMMENT_RE,
+    ".yml": _HASH_COMMENT_RE,
+    ".yaml": _HASH_COMMENT_RE,
+    ".toml": _HASH_COMMENT_RE,
+    "Dockerfile": _HASH_COMMENT_RE,
+    ".go": _SLASH_COMMENT_RE,
+    ".c": _SLASH_COMMENT_RE,
+    ".h": _SLASH_COMMENT_RE,
+    ".cpp": _SLASH_COMMENT_RE,
+    ".java": _SLASH_COMMENT_RE,
+    ".js": _SLASH_COMMENT_RE,
+    ".ts": _SLASH_COMMENT_RE,
+    ".rs": _SLASH_COMMENT_RE,
+}
+
+
+def parse_diff_to_changed_lines(patch):
+    """
+    Parses a git diff patch to identify which lines in the new file were added or modified.
+    Returns a set of line numbers (integers) in the new file.
+    """
+    changed_lines = set()
+    if not patch:
+        return changed_lines
+
+    current_new_line = 0
+
+    # Let the regex engine split lines and pick out prefixes in one pass
+    # instead of materializing a list of every line in the patch.
+    for line_match in _DIFF_LINE_RE.finditer(patch):
+        # Dispatch on the first character; hunk headers are rare, so only
+        # lines starting with "@" are run through the regex.
+        prefix = line_match.group(1)
+        if prefix == "+":
+            changed_lines.add(current_new_line)
+            current_new_line += 1
+        elif prefix == " ":
+            current_new_line += 1
+        elif prefix == "-":
+            # Removed line, does not advance new_line index
+            pass
+        elif prefix == "@":
+            match = _HUNK_HEADER_RE.match(patch, line_match.start())
+            if match:
+                current_new_line = int(match.group(2))
+
+    return changed_lines
+
+
+class RateLimiter:
+    """
+    Sliding-window rate limiter shared across threads.
+    Blocks in acquire() until fewer than `rpm` requests were made in the last minute.
+    An `rpm` of zero or less disables the limit.
+    """
+
+    def __init__(self, rpm, period=60.0):
+        self.rpm = rpm
+        self.period = period
+        self._timestamps = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rpm <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._timestamps and now - self._timestamps[0] >= self.period:
+                    self._timestamps.popleft()
+
+                if len(self._timestamps) < self.rpm:
+                    self._timestamps.append(now)
+                    return
+
+                wait = self.period - (now - self._timestamps[0])
+            time.sleep(wait)
+
+
+rate_limiter = RateLimiter(GEMINI_RPM)
+
+
+def _is_rate_limit_error(error):
+    message = str(error)
+    return "429" in message or "RESOURCE_EXHAUSTED" in message
+
+
+def generate_with_retry(model, prompt):
+    """
+    Calls model.generate_content, retrying rate-limit errors with
+    exponential backoff and jitter. Other errors are raised immediately.
+    """
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        rate_limiter.acquire()
+        try:
+            return model.generate_content(prompt)
+        except Exception as e:
+            if not _is_rate_limit_error(e) or attempt == GEMINI_MAX_ATTEMPTS - 1:
+                raise
+            delay = min(2**attempt + random.random(), GEMINI_MAX_BACKOFF_SECONDS)
+            print(f"Rate limited by Gemini, retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+def _review_cache_path(filename, patch):
+    key_parts = (
+        GEMINI_MODEL,
+        _PROMPT_FINGERPRINT,
+        str(MAX_PATCH_CHARS),
+        filename,
+        patch,
+    )
+    key = hashlib.sha256("\0".join(key_parts).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def load_cached_review(filename, patch):
+    """
+    Returns the cached review items for this patch, or None on a cache miss.
+    """
+    try:
+        with open(_review_cache_path(filename, patch), "rb") as f:
+            review_items = json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(review_items, list):
+        return None
+    return review_items
+
+
+def store_cached_review(filename, patch, review_items):
+    path = _review_cache_path(filename, patch)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write to a temp file first so concurrent readers never see partial JSON
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json_dumps(review_items))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Failed to cache review for {filename}: {e}")
+
 
+def parse_review_response(text, container_re=_JSON_ARRAY_RE):
+    """
+    Extracts the JSON review payload from the raw model output,
+    tolerating markdown fences and surrounding prose.
+    """
+    text = _JSON_FENCE_RE.match(text).group(1)
     try:
-        response = model.generate_content(prompt)
-        text = response.text.strip()
-        # Clean up markdown code blocks if present
-        if text.startswith("```json"):
-            text = text[7:]
-        if text.startswith("```"):
-            text = text[3:]
-        if text.endswith("```"):
-            text = text[:-3]
-
-        return json.loads(text.strip())
+        return json_loads(text)
+    except ValueError:
+        match = container_re.search(text)
+        if not match:
+            raise
+        return json_loads(match.group(0))
+
+
+def _comment_re_for(filename):
+    basename = os.path.basename(filename)
+    extension = os.path.splitext(basename)[1]
+    return _COMMENT_RE_BY_EXTENSION.get(extension or basename)
+
+
+def _is_trivial_patch(filename, patch):
+    """
+    Returns True if every added or removed line in the patch is blank or a comment
+    in the file's language, i.e. there is nothing worth sending to the model.
+    """
+    comment_re = _comment_re_for(filename)
+    for line in patch.split("\n"):
+        # GitHub patches carry no ---/+++ file headers, so every +/- line is content
+        if not line.startswith(("+", "-")):
+            continue
+        content = line[1:]
+        if not content.strip():
+            continue
+        if comment_re is None or not comment_re.match(content):
+            return False
+    return True
+
+
+def truncate_patch(patch, max_chars=MAX_PATCH_CHARS):
+    """
+    Keeps whole hunks from the start of the patch until max_chars is reached
+    and drops the rest. Falls back to a hard cut if the first hunk alone is too big.
+    """
+    if len(patch) <= max_chars:
+        return patch
+
+    cut = 0
+    for match in _HUNK_HEADER_RE.finditer(patch):
+        if match.start() > max_chars:
+            break
+        cut = match.start()
+
+    if cut == 0:
+        cut = max_chars
+
+    return patch[:cut].rstrip("\n") + "\n...[truncated]\n"
+
+
+def get_ai_review(filename, patch, model):
+    """
+    Sends the patch to Gemini for review.
+    Results are served from and stored in the on-disk cache.
+    """
+    cached = load_cached_review(filename, patch)
+    if cached is not None:
+        print(f"Using cached review for {filename}")
+        return cached
+
+    prompt_patch = truncate_patch(patch)
+    if prompt_patch is not patch:
+        print(f"Truncated patch for {filename} to {len(prompt_patch)} chars")
+
+    prompt = "".join(
+        (_PROMPT_PREFIX, filename, _PROMPT_MID, prompt_patch, _PROMPT_SUFFIX)
+    )
+
+    try:
+        response = generate_with_retry(model, prompt)
+        review_items = parse_review_response(response.text)
+        if not isinstance(review_items, list):
+            raise ValueError(f"expected a JSON list, got {type(review_items).__name__}")
+        store_cached_review(filename, patch, review_items)
+        return review_items
     except Exception as e:
         print(f"Error generating/parsing review for {filename}: {e}")
         return []
 
 
+def get_ai_batch_review(patches, model):
+    """
+    Sends several (filename, patch) pairs to Gemini in a single request.
+    Returns a dict mapping each filename to its list of review items.
+    """
+    reviews = {}
+    uncached = []
+    for filename, patch in patches:
+        cached = load_cached_review(filename, patch)
+        if cached is not None:
+            print(f"Using cached review for {filename}")
+            reviews[filename] = cached
+        else:
+            uncached.append((filename, patch))
+
+    if len(uncached) == 1:
+        filename, patch = uncached[0]
+        reviews[filename] = get_ai_review(filename, patch, model)
+    if len(uncached) <= 1:
+        return reviews
+
+    diffs = "\n\n".join(
+        f"File: {filename}\nDiff:\n{patch}" for filename, patch in uncached
+    )
+    prompt = "".join(
+        (
+            _BATCH_PROMPT_PREFIX,
+            str(len(uncached)),
+            _BATCH_PROMPT_MID,
+            diffs,
+            _BATCH_PROMPT_SUFFIX,
+        )
+    )
+
+    filenames = ", ".join(filename for filename, _ in uncached)
+    try:
+        response = generate_with_retry(model, prompt)
+        batch = parse_review_response(response.text, _JSON_OBJECT_RE)
+    except Exception as e:
+        print(
+            f"Error generating/parsing batch review for {filenames}: {e}; "
+            "reviewing separately"
+        )
+        batch = None
+
+    if not isinstance(batch, dict):
+        # Unusable batch reply; fall back to reviewing each file on its own
+        if batch is not None:
+            print(
+                f"Batch review for {filenames} returned "
+                f"{type(batch).__name__}, not an object; reviewing separately"
+            )
+        for filename, patch in uncached:
+            reviews[filename] = get_ai_review(filename, patch, model)
+        return reviews
+
+    for filename, patch in uncached:
+        review_items = batch.get(filename)
+        if isinstance(review_items, list):
+            reviews[filename] = review_items
+            store_cached_review(filename, patch, review_items)
+        else:
+            # The model left the file out or mangled its name; review it on its
+            # own rather than caching an empty result
+            print(f"Batch review missing {filename}, reviewing it separately")
+            reviews[filename] = get_ai_review(filename, patch, model)
+
+    return reviews
+
+
+def pack_batches(patches, max_chars=BATCH_MAX_CHARS):
+    """
+    Greedily groups (filename, patch) pairs, smallest first, into batches whose
+    combined patch size stays within max_chars. Larger patches get a batch of their own.
+    """
+    batches = []
+    current = []
+    current_size = 0
+    for filename, patch in sorted(patches, key=lambda pair: len(pair[1])):
+        if current and current_size + len(patch) > max_chars:
+            batches.append(current)
+            current = []
+            current_size = 0
+        current.append((filename, patch))
+        current_size += len(patch)
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+
+def review_batch(patches, model):
+    """
+    Computes the changed lines of each patch and requests their AI review,
+    using one Gemini request for the whole batch where possible.
+    Returns a list of (filename, changed_lines, review_items) tuples.
+    """
+    if len(patches) == 1:
+        filename, patch = patches[0]
+        reviews = {filename: get_ai_review(filename, patch, model)}
+    else:
+        reviews = get_ai_batch_review(patches, model)
+
+    results = []
+    for filename, patch in patches:
+        changed_lines = parse_diff_to_changed_lines(patch)
+        review_items = [item for item in reviews[filename] if isinstance(item, dict)]
+
+        # The model may return line numbers as strings; coerce them so the
+        # membership test against changed_lines works
+        for item in review_items:
+            try:
+                item["line"] = int(item.get("line"))
+            except (TypeError, ValueError):
+                item["line"] = None
+
+        results.append((filename, changed_lines, review_items))
+
+    return results
+
+
+def read_pr_number(event_path):
+    """
+    Returns the pull request number from the GitHub event payload,
+    or None if the event is not a pull request event.
+    """
+    with open(event_path, "rb") as f:
+        if ijson is not None:
+            # Stream-parse only the field we need instead of the whole payload
+            return next(ijson.items(f, "pull_request.number"), None)
+
+        event_data = json_loads(f.read())
+
+    return event_data.get("pull_request", {}).get("number")
+
+
 def main():
     github_token = os.environ.get("GITHUB_TOKEN")
     gemini_api_key = os.environ.get("GEMINI_API_KEY")
@@ -119,33 +565,37 @@ def main():
         return
 
     genai.configure(api_key=gemini_api_key)
+    # Shared by all review threads
+    model = genai.GenerativeModel(GEMINI_MODEL)
 
     # Get context from event
-    with open(os.environ["GITHUB_EVENT_PATH"], "r") as f:
-        event_data = json.load(f)
+    pr_number = read_pr_number(os.environ["GITHUB_EVENT_PATH"])
+    if pr_number is None:
+        print("Not a pull request event. Exiting.")
+        return
 
     auth = Auth.Token(github_token)
     g = Github(auth=auth)
 
-    if "pull_request" in event_data:
-        pr_number = event_data["pull_request"]["number"]
-        repo_name = os.environ["GITHUB_REPOSITORY"]
-
-        repo = g.get_repo(repo_name)
-        pr = repo.get_pull(pr_number)
-    else:
-        print("Not a pull request event. Exiting.")
-        return
+    repo_name = os.environ["GITHUB_REPOSITORY"]
+    repo = g.get_repo(repo_name)
+    pr = repo.get_pull(pr_number)
 
     print(f"Reviewing PR #{pr_number}: {pr.title}")
 
-    commits = pr.get_commits()
-    last_commit = commits[commits.totalCount - 1]
-
-    files = pr.get_files()
+    # Fetch the head commit directly rather than paging through every PR commit
+    last_commit = repo.get_commit(pr.head.sha)
 
-    comments_to_post = []
+    # Stop paginating once MAX_FILES have been fetched
+    max_files = MAX_FILES if MAX_FILES > 0 else None
+    files = itertools.islice(pr.get_files(), max_files)
+    if max_files is not None and pr.changed_files > max_files:
+        print(
+            f"PR changes {pr.changed_files} files; "
+            f"reviewing only the first {max_files}"
+        )
 
+    reviewable_patches = []
     for file in files:
         if file.status == "removed":
             continue
@@ -155,28 +605,59 @@ def main():
             print(f"Skipping {file.filename} (no patch available)")
             continue
 
-        print(f"Analyzing {file.filename}...")
-
-        changed_lines = parse_diff_to_changed_lines(file.patch)
-
-        review_items = get_ai_review(file.filename, file.patch)
+        if _is_trivial_patch(file.filename, file.patch):
+            print(f"Skipping {file.filename} (trivial)")
+            continue
 
-        for item in review_items:
-            line = item.get("line")
-            message = item.get("message")
-
-            if line in changed_lines:
-                print(f"  - Comment on line {line}: {message}")
-                comments_to_post.append(
-                    {
-                        "path": file.filename,
-                        "line": line,
-                        "side": "RIGHT",
-                        "body": message,
-                    }
+        reviewable_patches.append((file.filename, file.patch))
+
+    batches = pack_batches(reviewable_patches)
+    print(f"Reviewing {len(reviewable_patches)} files in {len(batches)} requests")
+
+    per_file_comments = []
+
+    # Each batch is an independent, IO-bound round-trip to Gemini, so run
+    # them concurrently and merge the results back on the main thread.
+    with ThreadPoolExecutor(max_workers=GEMINI_CONCURRENCY) as executor:
+        futures = {}
+        for batch in batches:
+            for filename, _ in batch:
+                print(f"Analyzing {filename}...")
+            futures[executor.submit(review_batch, batch, model)] = batch
+
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                # Keep going so comments from the other batches still get posted
+                filenames = ", ".join(filename for filename, _ in futures[future])
+                print(f"Error reviewing {filenames}: {e}")
+                continue
+
+            for filename, changed_lines, review_items in results:
+                valid_items = [
+                    item for item in review_items if item.get("line") in changed_lines
+                ]
+                per_file_comments.append(
+                    [
+                        {
+                            "path": filename,
+                            "line": item["line"],
+                            "side": "RIGHT",
+                            "body": item.get("message"),
+                        }
+                        for item in valid_items
+                    ]
                 )
-            else:
-                print(f"  - Skipped comment on line {line} (not in changed lines)")
+                print(
+                    f"  + {len(valid_items)}/{len(review_items)} comments kept "
+                    f"for {filename}"
+                )
+
+    # Flatten once all reviews have landed
+    comments_to_post = [
+        comment for comments in per_file_comments for comment in comments
+    ]
 
     if comments_to_post:
         print(f"Posting {len(comments_to_post)} comments...")